@@ -1,15 +1,29 @@
 import requests
-import datetime
+import hashlib
+import time
+import tempfile
+import orjson
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import numpy as np
 import pandas as pd
 import yfinance as yf
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 import os
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from pathlib import Path
 from dotenv import load_dotenv
 
 load_dotenv()
 
+CACHE_DIR = Path(__file__).parent / '.cache'
+CACHE_TTL_SECONDS = 24 * 60 * 60
+
 class Crypto:
 
     def __init__(self):
@@ -20,6 +34,7 @@ class Crypto:
             df (DataFrame): DataFrame for storing coin data.
             merged_df (DataFrame): DataFrame for storing merged market and crypto data.
             API_key (str): The API key retrieved from environment variables for CoinGecko.
+            session (Session): Keep-alive HTTP session carrying the CoinGecko headers, pooled for concurrent downloads.
 
         Raises:
             ValueError: If the API_KEY environment variable is not set.
@@ -30,6 +45,62 @@ class Crypto:
         self.API_key = os.getenv('API_KEY')
         if not self.API_key:
             raise ValueError("API_KEY environment variable is not set")
+        self.session = requests.Session()
+        self.session.headers.update({
+            "accept": "application/json",
+            "x-cg-pro-api-key": self.API_key})
+        self.session.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=16))
+
+    def _cache_path(self, namespace, *key, suffix='.json'):
+        """
+        Builds the on-disk cache location for a download.
+
+        Args:
+            namespace (str): Sub-directory of the cache (e.g. 'coingecko').
+            *key: Request parameters identifying the download.
+            suffix (str): File extension of the cached payload (default is '.json').
+
+        Returns:
+            Path: The cache file path; its directory is only created when a payload is written.
+        """
+        digest = hashlib.md5('|'.join(map(str, key)).encode()).hexdigest()
+        return CACHE_DIR / namespace / f"{digest}{suffix}"
+
+    def _cache_fresh(self, path, ttl_seconds=CACHE_TTL_SECONDS):
+        """
+        Checks whether a cache file exists and is still fresh.
+
+        Args:
+            path (Path): The cache file path from _cache_path.
+            ttl_seconds (int): Maximum age of the file in seconds, or None to never expire.
+
+        Returns:
+            bool: True if the cached file can be used.
+        """
+        if not path.exists():
+            return False
+        return ttl_seconds is None or time.time() - path.stat().st_mtime < ttl_seconds
+
+    def _cache_write(self, path, write):
+        """
+        Atomically stores a payload in the cache, so an interrupted or concurrent write never leaves a truncated file.
+
+        Args:
+            path (Path): The cache file path from _cache_path.
+            write (callable): Writes the payload to the temporary file path it is given.
+
+        Returns:
+            None: The payload is moved into place once fully written.
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+        os.close(fd)
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
 
     def yahoo_download(self, start_date, end_date):
         """
@@ -40,12 +111,22 @@ class Crypto:
             end_date (str): The end date in 'YYYY-MM-DD' format.
 
         Returns:
-            DataFrame: A DataFrame containing the historical NASDAQ data.
+            DataFrame: A DataFrame with the tz-naive trading 'date' and the NASDAQ 'Close'.
         """
-        nasdaq = yf.Ticker("^IXIC")
-        nasdaq_data = nasdaq.history(start=start_date, end=end_date)
-        nasdaq_data.index = nasdaq_data.index.tz_localize(None)
-        return nasdaq_data
+        ### History ending before today is final and never expires
+        cache_path = self._cache_path('yahoo', '^IXIC', start_date, end_date, 'raw', 'no-actions', suffix='.parquet')
+        final = pd.Timestamp(end_date).normalize() < pd.Timestamp.today().normalize()
+        if self._cache_fresh(cache_path, ttl_seconds=None if final else CACHE_TTL_SECONDS):
+            nasdaq_data = pd.read_parquet(cache_path)
+        else:
+            nasdaq = yf.Ticker("^IXIC")
+            nasdaq_data = nasdaq.history(start=start_date, end=end_date, auto_adjust=False, actions=False)
+            ### yfinance returns an empty frame on failure; never pin that in the cache
+            if not nasdaq_data.empty and 'Close' in nasdaq_data.columns:
+                self._cache_write(cache_path, nasdaq_data.to_parquet)
+        nasdaq_data = nasdaq_data[['Close']]
+        nasdaq_data.index = nasdaq_data.index.tz_localize(None).normalize().rename('date')
+        return nasdaq_data.reset_index()
 
     def coingekko_download(self, id=None, days=None, currency='usd', interval='daily', precision='2'):
         """
@@ -61,13 +142,15 @@ class Crypto:
         Returns:
             dict: A dictionary containing the historical data from CoinGecko.
         """
+        cache_path = self._cache_path('coingecko', id, days, currency, interval, precision)
+        if self._cache_fresh(cache_path):
+            return orjson.loads(cache_path.read_bytes())
+
         url = f"https://pro-api.coingecko.com/api/v3/coins/{id}/market_chart?vs_currency={currency}&days={days}&interval={interval}&precision={precision}"
-        headers = {
-            "accept": "application/json",
-            "x-cg-pro-api-key": self.API_key}
-        response = requests.get(url, headers=headers)
-        response.json()
-        return response.json()
+        response = self.session.get(url)
+        if response.ok:
+            self._cache_write(cache_path, lambda tmp_path: Path(tmp_path).write_bytes(response.content))
+        return orjson.loads(response.content)
 
     def data_transform(self, ids, days=None):
         """
@@ -75,32 +158,40 @@ class Crypto:
 
         Args:
             ids (list): A list of cryptocurrency IDs for which to download and process data.
+                Downloads run concurrently, one thread per ID (up to 16).
 
         Returns:
             DataFrame: A DataFrame containing transformed data with calculated weights and index values.
         """
-        rows = []
-        ### Download historical data for each coin
-        for id in ids:
-            coin_data = self.coingekko_download(id=id, days=days)
-            prices = coin_data['prices']
-            market_caps = coin_data['market_caps']
-            for price, market_cap in zip(prices, market_caps): ### json transformation
-                date = convert_timestamp(price[0])
-                price_value = price[1]
-                market_cap_value = market_cap[1]
-                rows.append([date, price_value, market_cap_value, id])
-
-        df = pd.DataFrame(rows, columns=['date', 'price', 'market_cap', 'id'])
+        ### Download historical data for each coin, once per distinct id
+        ids = list(dict.fromkeys(ids))
+        with ThreadPoolExecutor(max_workers=min(16, max(len(ids), 1))) as executor:
+            results = dict(zip(ids, executor.map(lambda id: self.coingekko_download(id=id, days=days), ids)))
+
+        ### json transformation into preallocated columns
+        counts = [min(len(coin_data['prices']), len(coin_data['market_caps'])) for coin_data in results.values()]
+        offsets = np.r_[0, np.cumsum(counts)].astype(np.int64)
+        timestamps = np.empty(offsets[-1], dtype=np.int64)
+        prices = np.empty(offsets[-1], dtype=np.float64)
+        market_caps = np.empty(offsets[-1], dtype=np.float64)
+        for start, end, coin_data in zip(offsets[:-1], offsets[1:], results.values()):
+            ### Pair prices and market caps up to the shorter list, as zip did
+            coin_prices = np.asarray(coin_data['prices'], dtype=np.float64).reshape(-1, 2)[:end - start]
+            timestamps[start:end] = coin_prices[:, 0]
+            prices[start:end] = coin_prices[:, 1]
+            market_caps[start:end] = np.asarray(coin_data['market_caps'], dtype=np.float64).reshape(-1, 2)[:end - start, 1]
+
+        df = pd.DataFrame({
+            'date': pd.to_datetime(timestamps, unit='ms').floor('D'),
+            'price': prices,
+            'market_cap': market_caps,
+            'id': pd.Categorical.from_codes(np.repeat(np.arange(len(results)), counts), categories=list(results))},
+            copy=False)
 
         ### Computation weight & index
-        for date in df['date'].unique():
-            total_market_cap = df[df['date'] == date]['market_cap'].sum()
-            for index, row in df[df['date'] == date].iterrows():
-                weight = row['market_cap'] / total_market_cap
-                index_value = weight * row['price']
-                df.loc[index, 'weight'] = weight
-                df.loc[index, 'index'] = index_value
+        df = df.sort_values(by=['date', 'id'], kind='stable', ignore_index=True)
+        date_codes, _ = pd.factorize(df['date'], sort=True)
+        df['weight'], df['index'] = weights_indices(date_codes, df['market_cap'].to_numpy(), df['price'].to_numpy())
         self.df = df
         return self.df
 
@@ -118,46 +209,59 @@ class Crypto:
         """
         ### Nasdaq data download and merge
         nasdaq_data = self.yahoo_download(start_date, end_date)
-        nasdaq_data = nasdaq_data.reset_index()
-        self.df['date'] = pd.to_datetime(self.df['date'])
-        nasdaq_data['Date'] = pd.to_datetime(nasdaq_data['Date'])
-        self.merged_df = pd.merge(self.df, nasdaq_data, left_on='date', right_on='Date', how='inner')
+        nasdaq_data['date'] = nasdaq_data['date'].astype(self.df['date'].dtype)
+        self.merged_df = pd.merge(self.df, nasdaq_data, on='date', how='inner', sort=False)
 
         #### Price % change and metric
-        self.merged_df = self.merged_df.sort_values(by=['id', 'date'])
-        self.merged_df['price_pct_change'] = self.merged_df.groupby('id')['price'].pct_change() * 100
-        self.merged_df['metric'] = self.merged_df['price_pct_change'] * self.merged_df['weight']
+        self.merged_df = self.merged_df.sort_values(by=['id', 'date'], kind='stable')
+        id_codes = self.merged_df['id'].cat.codes.to_numpy()
+        price = self.merged_df['price'].to_numpy()
+        same_id = np.r_[False, id_codes[1:] == id_codes[:-1]]
+        price_pct_change = np.where(same_id, price / np.r_[np.nan, price[:-1]] - 1, np.nan) * 100
+        self.merged_df['price_pct_change'] = price_pct_change
+        self.merged_df['metric'] = price_pct_change * self.merged_df['weight'].to_numpy()
+        self.merged_df = self.merged_df.convert_dtypes(convert_integer=False, dtype_backend='pyarrow')
 
         return self.merged_df
 
-    def comparison_graph(self, id, left_metric='metric', right_metric='Close'):
+    def comparison_graph(self, id, left_metric='metric', right_metric='Close', ax=None, twin_ax=None):
         """
-        Generates a comparison graph between two metrics for a given cryptocurrency ID.
+        Generates a comparison graph between two metrics for a given cryptocurrency ID and saves it as '<id>.png'.
 
         Args:
             id (str): The cryptocurrency ID for the comparison.
             left_metric (str): The column to be plotted on the left y-axis (default is 'metric').
             right_metric (str): The column to be plotted on the right y-axis (default is 'Close').
+            ax (Axes): Axes to draw on, cleared first so one figure can be reused across IDs (default is a new figure).
+            twin_ax (Axes): Right-hand twin of ax (from ax.twinx()) to reuse, cleared first (default is a new twin).
 
         Returns:
-            None: Displays the plot.
+            str: The path of the saved plot, or None if no merged data is available.
         """
         if self.merged_df.empty:
             print("No merged data available. Please run data_transform first.")
             return
 
         # Filter the merged DataFrame to only include rows for the given id
-        filter_df = self.merged_df[self.merged_df['id'] == id].copy()
-
-        ### Date mess
-        filter_df['date'] = pd.to_datetime(filter_df['date']).dt.date
+        filter_df = self.merged_df.loc[self.merged_df['id'] == id, ['date', left_metric, right_metric]]
         filter_df = filter_df.sort_values(by=['date'])
-        filter_df = filter_df.groupby('date', as_index=False).agg({
-            left_metric: 'sum',
-            right_metric: 'sum'
-        }).reset_index()
-        filter_df = filter_df.drop_duplicates(subset='date')
-        fig, ax1 = plt.subplots(figsize=(12, 6))
+        if not filter_df['date'].is_unique:
+            filter_df = filter_df.groupby('date', as_index=False).agg({
+                left_metric: 'sum',
+                right_metric: 'sum'
+            })
+        if ax is None:
+            fig, ax1 = plt.subplots(figsize=(12, 6))
+        else:
+            fig, ax1 = ax.figure, ax
+            ax1.clear()
+        if twin_ax is None:
+            ax2 = ax1.twinx()
+        else:
+            ### Clearing a twin resets its label side and the shared x ticks, so do it before drawing
+            ax2 = twin_ax
+            ax2.clear()
+            ax2.yaxis.set_label_position('right')
 
         ### Left graph
         ax1.plot(filter_df['date'], filter_df[left_metric], color='blue', label=f"{left_metric} ({id})", linestyle='-',
@@ -171,40 +275,67 @@ class Crypto:
         ax1.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
 
         ### Right graph
-        ax2 = ax1.twinx()
         ax2.plot(filter_df['date'], filter_df[right_metric], color='red', label=right_metric, linestyle='-', marker='o')
         ax2.set_ylabel(right_metric, color='red')
         ax2.tick_params(axis='y', colors='red')
         fig.autofmt_xdate()
 
         ### General stuff
-        plt.title(f'Comparison of {left_metric} vs {right_metric} for {id}')
+        ax2.set_title(f'Comparison of {left_metric} vs {right_metric} for {id}')
         fig.tight_layout()
 
-        return plt.show()
+        path = f'{id}.png'
+        fig.savefig(path, dpi=100)
+        if ax is None:
+            plt.close(fig)
+        return path
 
-    def run_script(self, ids=[], days=None):
+    def run_script(self, ids=[], days=None, plot=True, csv=True):
         """
         Executes the entire workflow of downloading, transforming, and visualizing cryptocurrency data.
 
         Args:
             ids (list): A list of cryptocurrency IDs to process.
+            plot (bool): Whether to save a comparison graph per ID (default is True).
+            csv (bool): Whether to write merged_data.csv (default is True).
 
         Returns:
-            None: Runs the entire script.
+            None: Runs the entire script, writing merged_data.csv and one '<id>.png' plot per ID unless disabled.
         """
 
         self.data_transform(ids, days=days)
         start_date = self.df['date'].min()
         end_date = self.df['date'].max()
         self.nasdaq_data_transform(start_date, end_date)
-        self.merged_df.to_csv('merged_data.csv')
+        if csv:
+            table = pa.Table.from_pandas(self.merged_df, preserve_index=False)
+            table = table.set_column(table.schema.get_field_index('date'), 'date', table['date'].cast(pa.date32()))
+            pacsv.write_csv(table, 'merged_data.csv')
 
+        if not plot:
+            return
+        fig, ax = plt.subplots(figsize=(12, 6))
+        twin_ax = ax.twinx()
         for id in ids:
-            self.comparison_graph(id=id, left_metric='metric', right_metric='Close')
-
-def convert_timestamp(timestamp):
-    return datetime.datetime.utcfromtimestamp(timestamp / 1000).strftime('%Y-%m-%d')
+            self.comparison_graph(id=id, left_metric='metric', right_metric='Close', ax=ax, twin_ax=twin_ax)
+        plt.close(fig)
+
+def weights_indices(date_codes, market_cap, price):
+    """
+    Computes each row's share of its date's total market cap and the resulting index value in one linear pass.
+
+    Args:
+        date_codes (ndarray): Integer date codes (0..D-1) for each row.
+        market_cap (ndarray): Market cap of each row.
+        price (ndarray): Price of each row.
+
+    Returns:
+        tuple: The weight and index value arrays.
+    """
+    ### Skip missing market caps in the daily total, like pandas' sum does
+    total_market_cap = np.bincount(date_codes, weights=np.nan_to_num(market_cap))
+    weight = market_cap / total_market_cap[date_codes]
+    return weight, weight * price
 
 ### Run through Commandline
 def main():
@@ -212,10 +343,12 @@ def main():
     parser = argparse.ArgumentParser(description="Crypto Data Analysis")
     parser.add_argument('-ids', '--ids', nargs='+', help='List of cryptocurrency IDs (e.g. bitcoin ethereum)', required=True)
     parser.add_argument('-days', '--days', help='No of days of history to fetch', required=True)
+    parser.add_argument('--no-plot', action='store_true', help='Skip saving the comparison graphs')
+    parser.add_argument('--no-csv', action='store_true', help='Skip writing merged_data.csv')
     args = parser.parse_args()
 
     crypto = Crypto()
-    crypto.run_script(ids=args.ids, days=args.days)
+    crypto.run_script(ids=args.ids, days=args.days, plot=not args.no_plot, csv=not args.no_csv)
 
 if __name__ == "__main__":
     main()